@@ -1,16 +1,121 @@
 """Lip Sync from audio file"""
 import argparse
 import csv
-import io
+import json
 import os
 import random
 import subprocess
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import ffmpeg
 
+FPS = 24
+MIN_SEGMENT_DURATION = 10.0
+
+
+def _cached_probe(path: str) -> Dict[str, Any]:
+    """Run ffprobe on the file and cache the result in a sidecar file
+
+    The result is stored next to the original file with the `.probe.json`
+    extension. For example, if the file is `some_file.mp3`, the sidecar will be
+    `some_file.mp3.probe.json`. The cache is keyed by the path, the
+    modification time and the size of the file, so it is refreshed whenever
+    the file changes.
+
+    Parameters
+    ----------
+    path : str
+        The path to the file to probe
+
+    Returns
+    -------
+    Dict[str, Any]
+        The output of ffprobe
+    """
+    stat = os.stat(path)
+    key = [os.path.abspath(path), stat.st_mtime, stat.st_size]
+    sidecar = path + ".probe.json"
+
+    try:
+        with open(sidecar, "r", encoding="utf-8") as fd:
+            cache = json.load(fd)
+        if cache["key"] == key:
+            return cache["probe"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    probe = ffmpeg.probe(path)
+
+    try:
+        with open(sidecar, "w", encoding="utf-8") as fd:
+            json.dump({"key": key, "probe": probe}, fd)
+    except OSError:
+        pass
+
+    return probe
+
+
+def read_mapping(path: str) -> Dict[str, str]:
+    """Read a mapping file from names to image paths
+
+    The mapping is a csv file without a header, where each row contains a name
+    and the path to the image. Relative paths are relative to the mapping file,
+    absolute paths are kept as they are.
+
+    Example
+    -------
+    > read_mapping("assets/sync.csv")
+    {"A": "assets/mouth-mbp.png", "B": "assets/mouth-sczdntgj.png", ...}
+
+    Parameters
+    ----------
+    path : str
+        The path to the mapping file
+
+    Returns
+    -------
+    Dict[str, str]
+        The mapping from names to image paths
+    """
+    mapping_path = Path(path)
+    base = os.path.join(mapping_path.parent, "")
+    with open(mapping_path, "r", encoding="utf-8") as fd:
+        return {
+            name: file if os.path.isabs(file) else base + file
+            for name, file in csv.reader(fd)
+        }
+
+
+def merge_chunks(chunks: List[Tuple[str, float]]) -> List[Tuple[str, float]]:
+    """Merge adjacent chunks that show the same image
+
+    Example
+    -------
+    > merge_chunks([("a.png", 0.5), ("a.png", 0.25), ("b.png", 1.0)])
+    [("a.png", 0.75), ("b.png", 1.0)]
+
+    Parameters
+    ----------
+    chunks : List[Tuple[str, float]]
+        The chunks containing the path to the images and the duration
+
+    Returns
+    -------
+    List[Tuple[str, float]]
+        The chunks where no two adjacent chunks show the same image
+    """
+    merged: List[Tuple[str, float]] = []
+    for image, duration in chunks:
+        if merged and merged[-1][0] == image:
+            merged[-1] = (image, merged[-1][1] + duration)
+        else:
+            merged.append((image, duration))
+
+    return merged
+
 
 def run_rhubarb(audio: str, lipsync: str) -> List[Tuple[str, float]]:
     """Run the rhubarb cli tool to generate the phoneme's
@@ -20,9 +125,10 @@ def run_rhubarb(audio: str, lipsync: str) -> List[Tuple[str, float]]:
     `.wav` format and then run rhubarb. The converted file name will be the
     same as the original file but with the `.wav` extension. For example, if
     the audio file is `some_file.mp3`, the converted file will be
-    `some_file.mp3.wav`. This will automatically overwrite any existing file
-    with the same name. If you want to keep the original file, make a copy of
-    it before running this function.
+    `some_file.mp3.wav`. The converted file is 16 kHz mono 16-bit PCM, which is
+    the format rhubarb works with internally. This will automatically overwrite
+    any existing file with the same name. If you want to keep the original
+    file, make a copy of it before running this function.
 
     It will generate a list with tuple elements. Each tuple will contain the
     path to the PNG file and the duration of that phoneme.
@@ -45,50 +151,51 @@ def run_rhubarb(audio: str, lipsync: str) -> List[Tuple[str, float]]:
         The chunks as a list of tuples of png files and durations
     """
     if not audio.endswith(".wav") and not audio.endswith(".ogg"):
-        ffmpeg.input(audio).output(audio + ".wav").overwrite_output().run()
+        ffmpeg.input(audio).output(
+            audio + ".wav", acodec="pcm_s16le", ar=16000, ac=1
+        ).overwrite_output().run()
         audio = audio + ".wav"
 
-    sync = subprocess.run(
-        ["rhubarb", "-q", audio],
+    lips = read_mapping(lipsync)
+
+    cmd = ["rhubarb", "-q", audio]
+    with subprocess.Popen(
+        cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         shell=False,
         text=True,
-        check=True,
-    ).stdout
-
-    frames = []
-    for time, name in csv.reader(io.StringIO(sync), delimiter="\t"):
-        frames.append((float(time), name))
+        bufsize=1,
+    ) as proc:
+        assert proc.stdout is not None and proc.stderr is not None
 
-    chunks = []
-    for i in range(len(frames) - 1):
-        stamp, name = frames[i]
-        next_stamp, _ = frames[i + 1]
-
-        duration = next_stamp - stamp
-        chunks.append((name, duration))
+        chunks: List[Tuple[str, float]] = []
+        prev_stamp, prev_name = 0.0, None
+        for time, name in csv.reader(proc.stdout, delimiter="\t"):
+            stamp = float(time)
+            if prev_name is not None:
+                chunks.append((lips[prev_name], stamp - prev_stamp))
+            prev_stamp, prev_name = stamp, name
 
-    lips = {}
-    lipsync_path = Path(lipsync)
-    with open(lipsync_path, "r", encoding="utf-8") as fd:
-        for name, file in csv.reader(fd):
-            lips[name] = os.path.join(lipsync_path.parent, file)
+        stderr = proc.stderr.read()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
 
-    return [
-        (lips[name], duration) for i, (name, duration) in enumerate(chunks)
-    ]
+    return merge_chunks(chunks)
 
 
 def run_blink(
-    audio: str, blink: Optional[str], min_wait: float = 2.0, max_wait: float = 4.0
+    duration: float,
+    blink: Optional[str],
+    min_wait: float = 2.0,
+    max_wait: float = 4.0,
 ) -> Optional[List[Tuple[str, float]]]:
     """Run the blink cli tool to generate the blink's
 
     Parameters
     ----------
-    audio : str
-        The path to the audio file to use
+    duration : float
+        The duration of the audio file in seconds
     blink : str
         The path to the blink file
     min_wait : float
@@ -98,7 +205,7 @@ def run_blink(
 
     Example
     -------
-    > run_blink("some_file.wav", "blink.csv")
+    > run_blink(12.5, "blink.csv")
     [("open.png", 2.56), ("closed.png", 0.04), ...]
 
     Returns
@@ -109,38 +216,409 @@ def run_blink(
     if blink is None:
         return None
 
-    duration = float(ffmpeg.probe(audio)["format"]["duration"])
+    blinks = read_mapping(blink)
+    opened = blinks["A"]
+    half = (blinks["B"], 1 / FPS)
+    closed = (blinks["C"], 1 / FPS)
 
     chunks = []
     while duration > 0:
         wait = random.uniform(min_wait, max_wait)
         wait = min(wait, duration)
 
-        chunks.extend([("A", wait), ("B", 1 / 24), ("C", 1 / 24)])
-        duration -= wait + 2 / 24
+        chunks += [(opened, wait), half, closed]
+        duration -= wait + 2 / FPS
+
+    return merge_chunks(chunks)
+
+
+def quote_path(path: str) -> str:
+    """Quote a path for a script of the ffmpeg concat demuxer
+
+    The path is made absolute and wrapped in single quotes, with the quotes in
+    it escaped.
+
+    Example
+    -------
+    > quote_path("/tmp/it's.png")
+    "'/tmp/it'\\''s.png'"
+
+    Parameters
+    ----------
+    path : str
+        The path to quote
+
+    Returns
+    -------
+    str
+        The quoted path
+    """
+    return "'" + os.path.abspath(path).replace("'", "'\\''") + "'"
+
+
+def write_concat(chunks: List[Tuple[str, float]], path: str):
+    """Write the chunks as a script for the ffmpeg concat demuxer
+
+    Each chunk becomes a `file` and `duration` pair. The last file is repeated
+    at the end of the script, otherwise the concat demuxer ignores its
+    duration.
+
+    Example
+    -------
+    > write_concat([("a.png", 0.56), ("closed.png", 1.2)], "lips.txt")
+
+    Parameters
+    ----------
+    chunks : List[Tuple[str, float]]
+        The chunks containing the path to the images and the duration
+    path : str
+        The path to the script file that will be written
+    """
+    with open(path, "w", encoding="utf-8") as fd:
+        fd.write("ffconcat version 1.0\n")
+        for image, duration in chunks:
+            fd.write(f"file {quote_path(image)}\nduration {duration}\n")
+
+        if chunks:
+            fd.write(f"file {quote_path(chunks[-1][0])}\n")
+
+
+def split_chunks(
+    chunks: List[Tuple[str, float]], parts: int
+) -> List[List[Tuple[str, float]]]:
+    """Split the chunks into parts of about the same duration
+
+    The chunks are never cut, the split happens between two chunks. A chunk
+    that covers several split points yields a single split.
+
+    Example
+    -------
+    > split_chunks([("a.png", 1.0), ("b.png", 1.0), ("a.png", 2.0)], 2)
+    [[("a.png", 1.0), ("b.png", 1.0)], [("a.png", 2.0)]]
+
+    Parameters
+    ----------
+    chunks : List[Tuple[str, float]]
+        The chunks containing the path to the images and the duration
+    parts : int
+        The maximum number of parts
+
+    Returns
+    -------
+    List[List[Tuple[str, float]]]
+        The chunks of each part
+    """
+    total = sum(duration for _, duration in chunks)
+    if total <= 0:
+        return [list(chunks)]
+
+    segments: List[List[Tuple[str, float]]] = [[]]
+    index = 0
+    elapsed = 0.0
+    for image, duration in chunks:
+        target = int(elapsed * parts / total)
+        if segments[-1] and target > index:
+            segments.append([])
+            index = target
+
+        segments[-1].append((image, duration))
+        elapsed += duration
+
+    return segments
+
+
+def slice_chunks(
+    chunks: List[Tuple[str, float]], start: float, end: float
+) -> List[Tuple[str, float]]:
+    """Keep only the part of the chunks between start and end
+
+    The chunks that cross the start or the end are shortened.
+
+    Example
+    -------
+    > slice_chunks([("a.png", 1.0), ("b.png", 1.0), ("a.png", 2.0)], 0.5, 2.5)
+    [("a.png", 0.5), ("b.png", 1.0), ("a.png", 0.5)]
+
+    Parameters
+    ----------
+    chunks : List[Tuple[str, float]]
+        The chunks containing the path to the images and the duration
+    start : float
+        The start time of the slice in seconds
+    end : float
+        The end time of the slice in seconds
+
+    Returns
+    -------
+    List[Tuple[str, float]]
+        The chunks of the slice
+    """
+    sliced = []
+    elapsed = 0.0
+    for image, duration in chunks:
+        if elapsed >= end:
+            break
+
+        overlap = min(elapsed + duration, end) - max(elapsed, start)
+        if overlap > 0:
+            sliced.append((image, overlap))
+        elapsed += duration
+
+    return sliced
+
+
+def segment_bounds(
+    chunks: List[Tuple[str, float]], parts: int
+) -> List[Tuple[float, float]]:
+    """Split the chunks into time ranges that start and end on a frame
+
+    The ranges follow `split_chunks`, but every boundary is rounded to the
+    nearest frame at `FPS` frames per second. This way each range can be
+    rendered on its own at a constant frame rate and the ranges can be joined
+    without drifting. A range shorter than `MIN_SEGMENT_DURATION` seconds is
+    merged into the one before it.
+
+    Example
+    -------
+    > segment_bounds([("a.png", 10.01), ("b.png", 10.0)], 2)
+    [(0.0, 10.0), (10.0, 20.0)]
+
+    Parameters
+    ----------
+    chunks : List[Tuple[str, float]]
+        The chunks containing the path to the images and the duration
+    parts : int
+        The maximum number of ranges
+
+    Returns
+    -------
+    List[Tuple[float, float]]
+        The start and end time of each range in seconds
+    """
+    bounds: List[Tuple[float, float]] = []
+    start = elapsed = 0.0
+    for segment in split_chunks(chunks, parts):
+        elapsed += sum(duration for _, duration in segment)
+        end = round(elapsed * FPS) / FPS
+        if end <= start:
+            continue
+
+        if bounds and end - start < MIN_SEGMENT_DURATION:
+            bounds[-1] = (bounds[-1][0], end)
+        else:
+            bounds.append((start, end))
+        start = end
+
+    return bounds
+
+
+def is_still_image(path: str) -> bool:
+    """Check if the file is a still image rather than a video
+
+    Parameters
+    ----------
+    path : str
+        The path to the file to check
+
+    Returns
+    -------
+    bool
+        True if ffmpeg reads the file with one of its image demuxers
+    """
+    format_name = ffmpeg.probe(path)["format"]["format_name"]
+    return format_name == "image2" or format_name.endswith("_pipe")
+
+
+def build_video(
+    lip_chunks: List[Tuple[str, float]],
+    blink_chunks: Optional[List[Tuple[str, float]]],
+    background: Optional[str],
+    start: float,
+    prefix: str,
+):
+    """Build the ffmpeg video stream that composites the chunks
+
+    The concat demuxer gives a single frame per chunk, while overlay only
+    outputs a frame when its main input has one. Every layer is therefore
+    converted to a constant `FPS` frame rate before it is composited, so no
+    blink or lip change falls between two frames and each chunk produces one
+    frame per `1 / FPS` seconds it covers.
+
+    Parameters
+    ----------
+    lip_chunks : List[Tuple[str, float]]
+        The chunks containing the path to the images and the duration
+    blink_chunks : Optional[List[Tuple[str, float]]]
+        The chunks containing the path to the blink images and the duration;
+        if none it will not use blink
+    background : Optional[str]
+        The path to the background image or video;
+        if none it will not use a background
+    start : float
+        The time in seconds to seek to in a background video;
+        zero if the background should not be seeked
+    prefix : str
+        The path prefix used for the concat scripts of the chunks
+
+    Returns
+    -------
+    ffmpeg.nodes.FilterableStream
+        The video stream
+    """
+    lips_txt = prefix + "lips.txt"
+    write_concat(lip_chunks, lips_txt)
+    layers = [ffmpeg.input(lips_txt, f="concat", safe=0).video.filter("fps", FPS)]
+
+    if background is not None:
+        if start > 0:
+            bottom = ffmpeg.input(background, ss=start).video
+        else:
+            bottom = ffmpeg.input(background).video
+        layers.insert(0, bottom.filter("fps", FPS))
+
+    if blink_chunks is not None:
+        blinks_txt = prefix + "blinks.txt"
+        write_concat(blink_chunks, blinks_txt)
+        layers.append(
+            ffmpeg.input(blinks_txt, f="concat", safe=0).video.filter("fps", FPS)
+        )
+
+    pipe = layers[0]
+    for layer in layers[1:]:
+        pipe = ffmpeg.filter([pipe, layer], "overlay")
+
+    return pipe
+
+
+def encode_video(
+    streams: List[Any],
+    output: str,
+    processes: int = 1,
+    frames: Optional[int] = None,
+):
+    """Build the ffmpeg output that encodes the composited video
+
+    The video is encoded with qtrle, which is lossless and keeps the alpha
+    channel. The available cores are shared between the ffmpeg processes that
+    run in parallel, both for the filter graph and for the encoder.
 
-    blinks = {}
-    blink_path = Path(blink)
-    with open(blink_path, "r", encoding="utf-8") as fd:
-        rd = csv.reader(fd)
-        for name, file in rd:
-            blinks[name] = os.path.join(blink_path.parent, file)
+    Parameters
+    ----------
+    streams : List[Any]
+        The ffmpeg streams to write in the output file
+    output : str
+        The path to the output video file
+    processes : int
+        The number of ffmpeg processes that run at the same time
+    frames : Optional[int]
+        The number of frames to write;
+        if none it will write until the longest input ends
 
-    for i, (name, duration) in enumerate(chunks):
-        chunks[i] = (blinks[name], duration)
+    Returns
+    -------
+    ffmpeg.nodes.OutputStream
+        The output stream
+    """
+    threads = max(1, (os.cpu_count() or 1) // processes)
 
-    return chunks
+    options: Dict[str, Any] = {"vcodec": "qtrle", "pix_fmt": "argb"}
+    if frames is not None:
+        options["vframes"] = frames
+
+    return ffmpeg.output(*streams, output, threads=threads, **options).global_args(
+        "-filter_complex_threads", str(threads)
+    )
 
 
-def generate_video(
+def render_segments(
+    lip_chunks: List[Tuple[str, float]],
+    blink_chunks: Optional[List[Tuple[str, float]]],
+    background: Optional[str],
+    parts: int,
+    tmp: str,
+) -> List[str]:
+    """Render the video in segments using parallel ffmpeg processes
+
+    The segments start and end on a frame, see `segment_bounds`, and each one
+    writes exactly the frames of its range, even when the background video is
+    longer. If any of the processes fails, the others are stopped before the
+    error is raised, since they write into `tmp`.
+
+    Parameters
+    ----------
+    lip_chunks : List[Tuple[str, float]]
+        The chunks containing the path to the images and the duration
+    blink_chunks : Optional[List[Tuple[str, float]]]
+        The chunks containing the path to the blink images and the duration;
+        if none it will not use blink
+    background : Optional[str]
+        The path to the background image or video;
+        if none it will not use a background
+    parts : int
+        The maximum number of segments
+    tmp : str
+        The directory where the segments are rendered
+
+    Returns
+    -------
+    List[str]
+        The paths to the rendered segments, in order
+    """
+    still = background is None or is_still_image(background)
+
+    segments = []
+    procs: List[subprocess.Popen] = []
+    try:
+        for i, (start, end) in enumerate(segment_bounds(lip_chunks, parts)):
+            segments.append(os.path.join(tmp, f"segment{i}.mov"))
+            pipe = build_video(
+                slice_chunks(lip_chunks, start, end),
+                (
+                    None
+                    if blink_chunks is None
+                    else slice_chunks(blink_chunks, start, end)
+                ),
+                background,
+                0.0 if still else start,
+                segments[-1] + ".",
+            )
+            procs.append(
+                encode_video([pipe], segments[-1], parts, round((end - start) * FPS))
+                .global_args("-nostats", "-loglevel", "error")
+                .overwrite_output()
+                .run_async()
+            )
+
+        for i, proc in enumerate(procs):
+            if proc.wait() != 0:
+                raise ffmpeg.Error(f"ffmpeg segment {i} ({segments[i]})", None, None)
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+
+    return segments
+
+
+def generate_video(  # pylint: disable=too-many-arguments
     lip_chunks: List[Tuple[str, float]],
     blink_chunks: Optional[List[Tuple[str, float]]],
     audio: str,
     background: Optional[str],
     output: str,
+    *,
+    jobs: int = 1,
 ):
     """Run ffmpeg to generate the video from the chunks
 
+    When more than one job is allowed, the video is split into segments of
+    about the same duration that are rendered in parallel by separate ffmpeg
+    processes. The segments are then
+    joined with the concat demuxer and muxed with the audio without encoding
+    the video again. Segments are never shorter than `MIN_SEGMENT_DURATION`
+    seconds.
+
     Parameters
     ----------
     lip_chunks : List[Tuple[str, float]]
@@ -155,34 +633,32 @@ def generate_video(
         if none it will not use a background image
     output : str
         The path to the output video file
+    jobs : int
+        The maximum number of ffmpeg processes to run in parallel
     """
-    pipe = ffmpeg.concat(
-        *[
-            ffmpeg.input(image, loop=1, t=duration)
-            for i, (image, duration) in enumerate(lip_chunks)
-        ],
-    )
-
-    if background is not None:
-        pipe = ffmpeg.overlay(
-            ffmpeg.input(background),
-            pipe,
-        )
-
-    if blink_chunks is not None:
-        pipe = ffmpeg.overlay(
-            pipe,
-            ffmpeg.concat(
-                *[
-                    ffmpeg.input(image, loop=1, t=duration)
-                    for i, (image, duration) in enumerate(blink_chunks)
-                ],
-            ),
-        )
-
-    pipe.output(
-        ffmpeg.input(audio), output, vcodec="qtrle", pix_fmt="argb"
-    ).overwrite_output().run()
+    total = sum(duration for _, duration in lip_chunks)
+    parts = max(1, min(jobs, int(total / MIN_SEGMENT_DURATION)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if parts == 1:
+            pipe = build_video(
+                lip_chunks, blink_chunks, background, 0.0, os.path.join(tmp, "")
+            )
+            encode_video([pipe, ffmpeg.input(audio)], output).overwrite_output().run()
+            return
+
+        segments = render_segments(lip_chunks, blink_chunks, background, parts, tmp)
+
+        segments_txt = os.path.join(tmp, "segments.txt")
+        with open(segments_txt, "w", encoding="utf-8") as fd:
+            fd.write("ffconcat version 1.0\n")
+            fd.writelines(f"file {quote_path(segment)}\n" for segment in segments)
+        ffmpeg.output(
+            ffmpeg.input(segments_txt, f="concat", safe=0).video,
+            ffmpeg.input(audio),
+            output,
+            vcodec="copy",
+        ).overwrite_output().run()
 
 
 @dataclass
@@ -201,6 +677,8 @@ class Args:
         The path to the file that will be used as a background image under the pngs
     output : str
         The name of the output file, will be a mkv video file
+    jobs : int
+        The maximum number of ffmpeg processes used to render the video
     """
 
     lipsync: str
@@ -208,6 +686,7 @@ class Args:
     audio: str
     background: Optional[str]
     output: str
+    jobs: int
 
 
 def parse_args() -> Args:
@@ -240,6 +719,12 @@ def parse_args() -> Args:
     parser.add_argument(
         "--output", type=str, help="name of the output file", required=True
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="number of ffmpeg processes used to render the video",
+        default=max(1, (os.cpu_count() or 1) // 2),
+    )
 
     args = parser.parse_args()
 
@@ -249,6 +734,7 @@ def parse_args() -> Args:
         audio=args.audio,
         background=args.background,
         output=args.output,
+        jobs=args.jobs,
     )
 
 
@@ -257,6 +743,17 @@ def main():
     args = parse_args()
 
     lip_chunks = run_rhubarb(args.audio, args.lipsync)
-    blink_chunks = run_blink(args.audio, args.blink)
 
-    generate_video(lip_chunks, blink_chunks, args.audio, args.background, args.output)
+    blink_chunks = None
+    if args.blink is not None:
+        duration = float(_cached_probe(args.audio)["format"]["duration"])
+        blink_chunks = run_blink(duration, args.blink)
+
+    generate_video(
+        lip_chunks,
+        blink_chunks,
+        args.audio,
+        args.background,
+        args.output,
+        jobs=args.jobs,
+    )
@@ -0,0 +1,149 @@
+"""Tests for the timeline helpers"""
+import os
+import tempfile
+import unittest
+
+from lip_sync.main import (
+    merge_chunks,
+    quote_path,
+    read_mapping,
+    segment_bounds,
+    slice_chunks,
+    split_chunks,
+    write_concat,
+)
+
+
+class TestReadMapping(unittest.TestCase):
+    """Tests for read_mapping"""
+
+    def test_joins_paths(self):
+        """Relative paths are joined to the mapping folder, absolute are kept"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sync.csv")
+            with open(path, "w", encoding="utf-8") as fd:
+                fd.write("A,mouth-a.png\nB,mouths/b.png\nX,/abs/closed.png\n")
+
+            mapping = read_mapping(path)
+
+        self.assertEqual(
+            mapping,
+            {
+                "A": os.path.join(tmp, "mouth-a.png"),
+                "B": os.path.join(tmp, "mouths", "b.png"),
+                "X": "/abs/closed.png",
+            },
+        )
+
+
+class TestMergeChunks(unittest.TestCase):
+    """Tests for merge_chunks"""
+
+    def test_merges_adjacent_images(self):
+        """Adjacent chunks with the same image become one chunk"""
+        chunks = [("a.png", 0.5), ("a.png", 0.25), ("b.png", 1.0), ("a.png", 2.0)]
+
+        self.assertEqual(
+            merge_chunks(chunks), [("a.png", 0.75), ("b.png", 1.0), ("a.png", 2.0)]
+        )
+
+    def test_empty(self):
+        """No chunks give no chunks"""
+        self.assertEqual(merge_chunks([]), [])
+
+
+class TestSplitChunks(unittest.TestCase):
+    """Tests for split_chunks"""
+
+    def test_equal_parts(self):
+        """The chunks are split between chunks at about equal durations"""
+        chunks = [("a.png", 1.0), ("b.png", 1.0), ("a.png", 2.0)]
+
+        self.assertEqual(
+            split_chunks(chunks, 2),
+            [[("a.png", 1.0), ("b.png", 1.0)], [("a.png", 2.0)]],
+        )
+
+    def test_chunk_covers_several_thresholds(self):
+        """A long chunk is never cut and yields a single split"""
+        chunks = [("a.png", 1.0), ("b.png", 8.0), ("c.png", 0.5), ("d.png", 0.5)]
+
+        segments = split_chunks(chunks, 4)
+
+        self.assertEqual(
+            segments,
+            [[("a.png", 1.0), ("b.png", 8.0)], [("c.png", 0.5), ("d.png", 0.5)]],
+        )
+        self.assertEqual(sum(segments, []), chunks)
+
+
+class TestSliceChunks(unittest.TestCase):
+    """Tests for slice_chunks"""
+
+    def test_crosses_both_edges(self):
+        """The chunks crossing the start and the end are shortened"""
+        chunks = [("a.png", 1.0), ("b.png", 1.0), ("a.png", 2.0)]
+
+        self.assertEqual(
+            slice_chunks(chunks, 0.5, 2.5),
+            [("a.png", 0.5), ("b.png", 1.0), ("a.png", 0.5)],
+        )
+
+    def test_inside_one_chunk(self):
+        """A slice inside a single chunk keeps only that chunk"""
+        chunks = [("a.png", 1.0), ("b.png", 4.0), ("a.png", 1.0)]
+
+        self.assertEqual(slice_chunks(chunks, 2.0, 3.0), [("b.png", 1.0)])
+
+
+class TestSegmentBounds(unittest.TestCase):
+    """Tests for segment_bounds"""
+
+    def test_boundaries_are_frames(self):
+        """The boundaries are rounded to the nearest frame"""
+        chunks = [("a.png", 10.01), ("b.png", 10.0)]
+
+        self.assertEqual(segment_bounds(chunks, 2), [(0.0, 10.0), (10.0, 20.0)])
+
+    def test_short_tail_is_merged(self):
+        """A range shorter than the minimum joins the previous range"""
+        chunks = [("a.png", 0.1), ("b.png", 15.0), ("c.png", 5.4)]
+
+        self.assertEqual(segment_bounds(chunks, 2), [(0.0, 20.5)])
+
+
+class TestQuotePath(unittest.TestCase):
+    """Tests for quote_path"""
+
+    def test_escapes_quotes(self):
+        """Single quotes are closed, escaped and reopened"""
+        self.assertEqual(quote_path("/tmp/it's.png"), "'/tmp/it'\\''s.png'")
+
+
+class TestWriteConcat(unittest.TestCase):
+    """Tests for write_concat"""
+
+    def test_quotes_and_repeats_last_file(self):
+        """Quotes are escaped and the last file is repeated"""
+        with tempfile.TemporaryDirectory() as tmp:
+            first = os.path.join(tmp, "a.png")
+            second = os.path.join(tmp, "it's.png")
+            path = os.path.join(tmp, "lips.txt")
+
+            write_concat([(first, 0.5), (second, 1.25)], path)
+
+            with open(path, "r", encoding="utf-8") as fd:
+                script = fd.read()
+
+        quoted = os.path.join(tmp, "it'\\''s.png")
+        self.assertEqual(
+            script,
+            "ffconcat version 1.0\n"
+            f"file '{first}'\nduration 0.5\n"
+            f"file '{quoted}'\nduration 1.25\n"
+            f"file '{quoted}'\n",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()